@@ -6,10 +6,12 @@ import logging
 from google.cloud import bigquery, storage
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from cachetools import LRUCache, cachedmethod
 
+from CacheManager import get_shared_cache
 from GoogleCloudStorageManager import GoogleCloudStorageManager
 
+BUFFER_CACHE_KEY = "buffer_check"
+
 
 class BigQueryManager:
     """
@@ -23,7 +25,7 @@ class BigQueryManager:
         client (Client): The BigQuery client.
     """
 
-    def __init__(self, project_id, dataset_id, user_dataset):
+    def __init__(self, project_id, dataset_id, user_dataset, cache=None):
         """
         Initializes the BigQueryManager with the provided credentials file,
         project ID, and dataset ID.
@@ -31,6 +33,9 @@ class BigQueryManager:
         Args:
             project_id (str): The Google Cloud project ID.
             dataset_id (str): The BigQuery dataset ID.
+            user_dataset (str): The user dataset the logs are filtered on.
+            cache (SharedCacheManager): Cache shared across user datasets.
+                Defaults to the process-wide shared cache.
         """
         load_dotenv()
         self.project_id = project_id
@@ -38,10 +43,11 @@ class BigQueryManager:
         self.dataset_id = dataset_id
         self.user_dataset = user_dataset
 
-        self.cache = LRUCache(maxsize=1000000)
+        self.cache = cache if cache is not None else get_shared_cache()
+        # The cached rows come from this project's log table for this dataset
+        self.cache_namespace = (project_id, dataset_id, user_dataset)
 
     
-    @cachedmethod(cache=lambda self: self.cache, key=lambda self, myVal: "myVal")
     def buffer_check(self, input_text):
         """
         Checks if the provided input text already exists in the 'de_genai_logs' table
@@ -51,7 +57,8 @@ class BigQueryManager:
             input_text (str): The user input text to check for in the table.
 
         Returns:
-            bool: True if the input text is found in the table, False otherwise.
+            list: The successful log entries of the user dataset, or None if
+            the lookup failed.
         """
         try:
            
@@ -73,24 +80,37 @@ class BigQueryManager:
             return data_objects
         except Exception as e:
             logging.error(f"An error occurred during buffer check: {e}")
-            return []
+            return None
 
     def fetch_query(self, input_text):
-        # Check if the result is already in the cache
-        if "myVal" in self.cache and len(self.cache["myVal"]) > 0:
+        # Check if the result is already in this dataset's cache namespace
+        cached = self.cache.get(self.cache_namespace, BUFFER_CACHE_KEY)
+        if cached is not None:
             print("CACHE_DATA <<<<<<<<<<<<<<<<< :")
             
-            return self.cache["myVal"]
+            return cached
         else:
             # If not in cache, perform the query and store the result
             print("BQ DATA-BASE >>>>>>>>>>>>>>>>>>>>>>>>>>>>> : ")
             
             result = self.buffer_check(input_text)
-            self.cache["myVal"] = result
+            if result is None:
+                # Don't cache a failed lookup as an empty log
+                return []
+            self.cache.set(self.cache_namespace, BUFFER_CACHE_KEY, result)
             
-            return self.cache["myVal"]
+            return result
 
-    
+    def remember_logged_query(self, input_text, generated_query):
+        # Adds a newly logged query to the cached log list instead of dropping
+        # the list, so the next lookup does not read the whole log table again
+        def add_entry(cached):
+            if any(entry["input_text"] == input_text for entry in cached):
+                return None
+            return cached + [{"input_text": input_text, "generated_query": generated_query}]
+
+        if not self.cache.update(self.cache_namespace, BUFFER_CACHE_KEY, add_entry):
+            self.cache.invalidate(self.cache_namespace, BUFFER_CACHE_KEY)
 
     def run_query(self, _query, input_text, status_id):
         """
@@ -131,6 +151,10 @@ class BigQueryManager:
                 return []
             else:
                 print("Data inserted successfully.")
+
+                if status_id == 1:
+                    self.remember_logged_query(input_text, _query)
+
                 query = f"SELECT created_at FROM `{self.project_id}.{self.dataset_id}.de_genai_logs` ORDER BY created_at DESC LIMIT 1;"
 
                 # Run the query
@@ -193,6 +217,66 @@ class BigQueryManager:
             
             return []
 
+    def export_generated_query(self, gen_query, preview_rows=10):
+        """
+        Runs the generated query and shards its result table to Google Cloud
+        Storage with a server-side extract job, so large results never pass
+        through this process. Only the first few rows are fetched through the
+        client as an inline preview.
+
+        Args:
+            gen_query (str): The SQL query to execute.
+            preview_rows (int): Number of rows to return inline as a preview.
+
+        Returns:
+            dict: The export URIs, the preview rows and the total row count, or
+            an empty list if the query or the export failed.
+        """
+        try:
+            unique_identifier = (
+                f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+            )
+            export_name = f"genarated_output{unique_identifier}"
+
+            query_job = self.client.query(gen_query)
+
+            # Only the first page is pulled through the client for the preview
+            results = query_job.result(max_results=preview_rows)
+            total_rows = results.total_rows
+            preview = [dict(row.items()) for row in results]
+
+            # Extract from the job's anonymous result table, which BigQuery
+            # expires on its own after a day
+            table_ref = query_job.destination
+
+            bucket_name = os.getenv("BUCKET_NAME")
+            destination_uri = f"gs://{bucket_name}/{export_name}/part-*.csv"
+            extract_config = bigquery.ExtractJobConfig(
+                destination_format=bigquery.DestinationFormat.CSV
+            )
+            extract_job = self.client.extract_table(
+                table_ref, destination_uri, job_config=extract_config
+            )
+            extract_job.result()
+
+            storage = GoogleCloudStorageManager(bucket_name, project_id=self.project_id)
+            export_uris = storage.list_gs_urls(f"{export_name}/")
+            if not export_uris:
+                print(f"No exported files found for {export_name}")
+                return []
+
+            print("EXPORT URIS", export_uris)
+            return {
+                "uris": export_uris,
+                "preview": preview,
+                "total_rows": total_rows,
+            }
+
+        except Exception as e:
+            print(f"An error occurred during generated query export: {e}")
+
+            return []
+
     def write_response_to_csv(self, response_data, csv_filename):
         with open(csv_filename, "w", newline="") as csv_file:
             csv_writer = csv.writer(csv_file)
@@ -0,0 +1,302 @@
+import os
+import sys
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+
+class _CacheEntry:
+    """
+    A single cached value together with its owning tenant, approximate size
+    in bytes and expiry time.
+    """
+
+    __slots__ = ("tenant", "key", "value", "size", "expires_at")
+
+    def __init__(self, tenant, key, value, size, expires_at):
+        self.tenant = tenant
+        self.key = key
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+
+
+class _TenantStats:
+    """
+    Byte usage and hit/miss/eviction/expiration counters for one tenant
+    namespace.
+    """
+
+    __slots__ = ("size", "entries", "hits", "misses", "evictions", "expirations")
+
+    def __init__(self):
+        self.size = 0
+        self.entries = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def approximate_size(value):
+    """
+    Estimate the memory footprint of a value in bytes, following the
+    containers the BigQuery row dictionaries are built from.
+
+    Args:
+        value: The value to measure.
+
+    Returns:
+        int: The approximate size in bytes.
+    """
+    seen = set()
+    stack = [value]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return total
+
+
+class SharedCacheManager:
+    """
+    SharedCacheManager is a process-wide LRU cache partitioned into tenant
+    namespaces (one per user dataset and log table). Eviction is driven by the approximate
+    byte cost of the entries, both against a global budget and against a
+    per-tenant quota, so memory stays bounded however many datasets are served.
+    Entries can optionally expire after a time-to-live.
+
+    Attributes:
+        max_bytes (int): Global byte budget across all tenants.
+        tenant_quota_bytes (int): Byte budget for a single tenant.
+        ttl (float): Seconds an entry stays valid, or None to never expire.
+    """
+
+    def __init__(
+        self,
+        max_bytes,
+        tenant_quota_bytes=None,
+        getsizeof=approximate_size,
+        ttl=None,
+        timer=time.monotonic,
+    ):
+        """
+        Initializes the SharedCacheManager.
+
+        Args:
+            max_bytes (int): Global byte budget across all tenants.
+            tenant_quota_bytes (int): Byte budget for a single tenant. Defaults
+                to the global budget.
+            getsizeof (callable): Function returning the byte cost of a value.
+            ttl (float): Seconds an entry stays valid. Entries never expire
+                when None.
+            timer (callable): Clock the time-to-live is measured against.
+        """
+        self.max_bytes = max_bytes
+        self.tenant_quota_bytes = tenant_quota_bytes or max_bytes
+        self.getsizeof = getsizeof
+        self.ttl = ttl
+        self.timer = timer
+        self.current_bytes = 0
+
+        self._entries = OrderedDict()
+        self._tenants = {}
+        self._lock = threading.RLock()
+
+    def _tenant_stats(self, tenant):
+        stats = self._tenants.get(tenant)
+        if stats is None:
+            stats = self._tenants[tenant] = _TenantStats()
+        return stats
+
+    def _remove(self, entry_key, evicted=False, expired=False):
+        entry = self._entries.pop(entry_key)
+        stats = self._tenants[entry.tenant]
+        stats.size -= entry.size
+        stats.entries -= 1
+        if evicted:
+            stats.evictions += 1
+        if expired:
+            stats.expirations += 1
+        self.current_bytes -= entry.size
+
+    def get(self, tenant, key, default=None):
+        """
+        Returns the cached value for a key in a tenant namespace.
+
+        Args:
+            tenant (hashable): The tenant namespace, e.g. a log table and user dataset.
+            key (str): The key within the namespace.
+            default: Value returned when the key is not cached.
+
+        Returns:
+            The cached value, or the default on a miss.
+        """
+        with self._lock:
+            stats = self._tenant_stats(tenant)
+            entry = self._entries.get((tenant, key))
+            if entry is not None and entry.expires_at is not None and entry.expires_at <= self.timer():
+                self._remove((tenant, key), expired=True)
+                entry = None
+
+            if entry is None:
+                stats.misses += 1
+                return default
+
+            self._entries.move_to_end((tenant, key))
+            stats.hits += 1
+            return entry.value
+
+    def set(self, tenant, key, value):
+        """
+        Stores a value in a tenant namespace, evicting the least recently used
+        entries of the tenant and then of the whole cache until both budgets
+        are respected. Values larger than the tenant quota are not cached.
+
+        Args:
+            tenant (hashable): The tenant namespace, e.g. a log table and user dataset.
+            key (str): The key within the namespace.
+            value: The value to cache.
+
+        Returns:
+            bool: True if the value was cached, False if it was too large.
+        """
+        size = self.getsizeof(value)
+        with self._lock:
+            stats = self._tenant_stats(tenant)
+            if (tenant, key) in self._entries:
+                self._remove((tenant, key), evicted=False)
+
+            if size > min(self.tenant_quota_bytes, self.max_bytes):
+                logging.warning(
+                    f"Cache entry {key} for {tenant} is {size} bytes and exceeds the quota; not cached"
+                )
+                return False
+
+            if stats.size + size > self.tenant_quota_bytes:
+                for entry_key in [k for k in self._entries if k[0] == tenant]:
+                    self._remove(entry_key, evicted=True)
+                    if stats.size + size <= self.tenant_quota_bytes:
+                        break
+
+            while self.current_bytes + size > self.max_bytes:
+                self._remove(next(iter(self._entries)), evicted=True)
+
+            expires_at = self.timer() + self.ttl if self.ttl is not None else None
+            self._entries[(tenant, key)] = _CacheEntry(tenant, key, value, size, expires_at)
+            stats.size += size
+            stats.entries += 1
+            self.current_bytes += size
+            return True
+
+    def update(self, tenant, key, function):
+        """
+        Atomically replaces a cached value with function(value), keeping its
+        expiry time. Nothing changes when the key is not cached or when the
+        function returns None. Updates do not count as hits or misses.
+
+        Args:
+            tenant (hashable): The tenant namespace.
+            key (str): The key within the namespace.
+            function (callable): Returns the new value from the current one.
+
+        Returns:
+            bool: False if the new value was too large to stay cached.
+        """
+        with self._lock:
+            entry = self._entries.get((tenant, key))
+            if entry is None or (entry.expires_at is not None and entry.expires_at <= self.timer()):
+                return True
+
+            value = function(entry.value)
+            if value is None:
+                return True
+
+            if not self.set(tenant, key, value):
+                return False
+            self._entries[(tenant, key)].expires_at = entry.expires_at
+            return True
+
+    def invalidate(self, tenant, key=None):
+        """
+        Drops one key, or every key, of a tenant namespace.
+
+        Args:
+            tenant (hashable): The tenant namespace.
+            key (str): The key to drop. Drops the whole namespace when None.
+        """
+        with self._lock:
+            if key is not None:
+                if (tenant, key) in self._entries:
+                    self._remove((tenant, key), evicted=False)
+                return
+
+            for entry_key in [k for k in self._entries if k[0] == tenant]:
+                self._remove(entry_key, evicted=False)
+
+    def stats(self, tenant=None):
+        """
+        Returns byte usage and hit/miss/eviction/expiration counters.
+
+        Args:
+            tenant (hashable): Restrict the stats to one tenant namespace.
+
+        Returns:
+            dict: The counters of the tenant, or the totals together with a
+            per-tenant breakdown.
+        """
+        with self._lock:
+            if tenant is not None:
+                return self._tenant_stats(tenant).as_dict()
+
+            tenants = {name: stats.as_dict() for name, stats in self._tenants.items()}
+            return {
+                "size": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "entries": len(self._entries),
+                "hits": sum(stats["hits"] for stats in tenants.values()),
+                "misses": sum(stats["misses"] for stats in tenants.values()),
+                "evictions": sum(stats["evictions"] for stats in tenants.values()),
+                "expirations": sum(stats["expirations"] for stats in tenants.values()),
+                "tenants": tenants,
+            }
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_shared_cache():
+    """
+    Returns the process-wide SharedCacheManager, creating it on first use from
+    the CACHE_MAX_BYTES, CACHE_TENANT_QUOTA_BYTES and CACHE_TTL_SECONDS
+    environment variables.
+
+    Returns:
+        SharedCacheManager: The shared cache.
+    """
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            load_dotenv()
+            max_bytes = int(os.getenv("CACHE_MAX_BYTES", 256 * 1024 * 1024))
+            tenant_quota_bytes = int(os.getenv("CACHE_TENANT_QUOTA_BYTES", max_bytes // 4))
+            ttl = os.getenv("CACHE_TTL_SECONDS")
+            _shared_cache = SharedCacheManager(
+                max_bytes, tenant_quota_bytes, ttl=float(ttl) if ttl else None
+            )
+        return _shared_cache
@@ -1,7 +1,9 @@
 import re
+import json
 import openai
 import logging
 from BigQueryConnect import BigQueryManager
+from OpenAIClient import RateLimitedOpenAIClient, get_shared_client
 from dotenv import load_dotenv
 import os
 
@@ -12,6 +14,9 @@ from util import LogUtil
 # Set up logging at the beginning of your application
 LogUtil.setup_logging(log_file="interface.log", level=logging.INFO)
 
+# Completion token budget for the answer to one question
+ANSWER_TOKENS = 1500
+
 
 class GPTBigQueryInterface:
     """
@@ -19,7 +24,7 @@ class GPTBigQueryInterface:
     input using GPT and log them to BigQuery.
     """
 
-    def __init__(self, project_id, user_dataset):
+    def __init__(self, project_id, user_dataset, bq_manager=None, llm_client=None):
         """
         Initialize the GPTBigQueryInterface.
 
@@ -27,20 +32,29 @@ class GPTBigQueryInterface:
             bq_credentials_path (str): Path to the BigQuery service account credentials file.
             project_id (str): Google Cloud project ID.
             user_dataset (str): BigQuery dataset ID.
+            bq_manager (BigQueryManager): BigQuery manager to use instead of
+                creating one, e.g. a simulated one for workload replay.
+            llm_client (RateLimitedOpenAIClient): GPT client to use instead of
+                the process-wide shared client.
         """
         load_dotenv()
 
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        # Check if the OPENAI_API_KEY is loaded properly
-        if not openai.api_key:
-            logging.error("OPENAI_API_KEY not found in environment variables.")
-            raise ValueError(
-                "OPENAI_API_KEY is required to authenticate GPT API requests."
-            )
+        if llm_client is None:
+            openai.api_key = os.getenv("OPENAI_API_KEY")
+            # Check if the OPENAI_API_KEY is loaded properly
+            if not openai.api_key:
+                logging.error("OPENAI_API_KEY not found in environment variables.")
+                raise ValueError(
+                    "OPENAI_API_KEY is required to authenticate GPT API requests."
+                )
+            llm_client = get_shared_client()
         self.project_dataset = os.getenv("PROJECT_DATASET")
         self.project_id = project_id
         self.user_dataset = user_dataset
-        self.bq_manager = BigQueryManager(self.project_id, self.project_dataset, self.user_dataset)
+        if bq_manager is None:
+            bq_manager = BigQueryManager(self.project_id, self.project_dataset, self.user_dataset)
+        self.bq_manager = bq_manager
+        self.llm_client = llm_client
         self.prompt = None
 
         logging.basicConfig(level=logging.INFO)
@@ -73,11 +87,11 @@ class GPTBigQueryInterface:
             list: A list of SQL queries extracted from the response.
         """
         try:
-            response = openai.chat.completions.create(
+            response = self.llm_client.create_chat_completion(
                 model="gpt-4",
                 messages=messages,
                 temperature=0.1,
-                max_tokens=1500,
+                max_tokens=ANSWER_TOKENS,
             )
             respStr = response.choices[0].message.content
             sql_queries = self.extract_sql_query(respStr)
@@ -94,13 +108,55 @@ class GPTBigQueryInterface:
             logging.exception(f"Error getting SQL query from response: {e}")
             return []
 
-    def run(self, input_text, upload_file_path):
+    def execute_generated_query(self, query, server_side_export=False):
+        """
+        Execute a generated SQL query and publish its result to Cloud Storage.
+
+        Args:
+            query (str): The SQL query to execute.
+            server_side_export (bool): Export the result with a BigQuery extract
+                job and return an inline preview instead of a single CSV link.
+
+        Returns:
+            str or dict: The CSV link, or the export URIs with a preview and
+            the total row count. Empty on failure.
+        """
+        if server_side_export:
+            return self.bq_manager.export_generated_query(query)
+
+        return self.bq_manager.run_generated_query(query)
+
+    def execute_and_log_query(self, query, input_text, server_side_export=False):
+        """
+        Execute a generated SQL query and log it with its execution status.
+
+        Args:
+            query (str): The SQL query to execute.
+            input_text (str): The user input text the query was generated from.
+            server_side_export (bool): Export the result server-side.
+
+        Returns:
+            str or dict: The result link(s), empty on failure.
+        """
+        gs_link = self.execute_generated_query(query, server_side_export)
+
+        query_exec_status = 0
+        if len(gs_link) > 0:
+            query_exec_status = 1
+
+        time_val = self.bq_manager.run_query(query, input_text, query_exec_status)
+        print("TIMESTAMP", time_val)
+        return gs_link
+
+    def run(self, input_text, upload_file_path, server_side_export=False):
         """
         Main method to run the interface. Checks if the input is already logged,
         gets the SQL query from GPT, and logs it to BigQuery.
 
         Args:
             input_text (str): The user's input text to process.
+            server_side_export (bool): Export large results server-side instead
+                of streaming every row through the client.
         """
         gs_link = None
         try:
@@ -119,19 +175,10 @@ class GPTBigQueryInterface:
                     f"Input already exists in BigQuery : { gen_query}"
                 )
                 
-                gs_link = self.bq_manager.run_generated_query(
-                    gen_query
+                gs_link = self.execute_and_log_query(
+                    gen_query, input_text, server_side_export
                 )
 
-                query_exec_status = 0
-                if len(gs_link) > 0:
-                    query_exec_status = 1
-
-                time_val = self.bq_manager.run_query(
-                    gen_query, input_text, query_exec_status
-                )
-                print("TIMESTAMP", time_val)
-
             else:
                 if (self.prompt is None):
                     self.prompt = prompt.construct_prompt(upload_file_path)
@@ -146,16 +193,9 @@ class GPTBigQueryInterface:
                 if len(sql_queries) > 0:
                     query = sql_queries[0]
                     logging.info(f"SQL Query: {query}")
-                    gs_link = self.bq_manager.run_generated_query(query)
-
-                    query_exec_status = 0
-                    if len(gs_link) > 0:
-                        query_exec_status = 1
-
-                    time_val = self.bq_manager.run_query(
-                        query, input_text, query_exec_status
+                    gs_link = self.execute_and_log_query(
+                        query, input_text, server_side_export
                     )
-                    print("TIMESTAMP", time_val)
                 
                 
 
@@ -167,6 +207,200 @@ class GPTBigQueryInterface:
             )
             logging.exception(f"Exception in running the interface: {e}")
     
+    def parse_batch_response(self, response_text, count):
+        """
+        Split a structured multi-answer GPT response back into one response
+        per question.
+
+        Args:
+            response_text (str): The JSON response listing the answers by id.
+            count (int): Number of questions that were asked.
+
+        Returns:
+            list: The SQL text answered for each question, None where the
+            answer is missing.
+        """
+        answers = [None] * count
+        decoder = json.JSONDecoder()
+
+        # Decode the answer objects one by one, so a response wrapped in a code
+        # fence or truncated at max_tokens still yields its complete answers
+        start = response_text.find("[")
+        position = response_text.find("{", start + 1) if start >= 0 else -1
+        while position >= 0:
+            try:
+                entry, end = decoder.raw_decode(response_text, position)
+            except ValueError:
+                position = response_text.find("{", position + 1)
+                continue
+
+            # Prose such as "[1]" before the JSON makes the scan start outside
+            # the answers list, in which case the wrapper object is decoded
+            # whole and its answers are read from it
+            if isinstance(entry, dict) and isinstance(entry.get("answers"), list):
+                entries = entry["answers"]
+            else:
+                entries = [entry]
+
+            for entry in entries:
+                try:
+                    index = int(entry["id"]) - 1
+                    if not isinstance(entry["sql"], str):
+                        raise TypeError("sql is not a string")
+                    if 0 <= index < count:
+                        answers[index] = entry["sql"] or None
+                except (KeyError, TypeError, ValueError) as e:
+                    logging.error(f"Skipping malformed batch answer {entry}: {e}")
+            position = response_text.find("{", end)
+
+        if not any(answers):
+            logging.error(f"No answers found in batch GPT response: {response_text}")
+        return answers
+
+    def get_sql_queries_from_batch_response(self, messages, input_texts):
+        """
+        Get the SQL queries for several questions from a single GPT response.
+
+        Args:
+            messages (list): The batch conversation built by GPTPromptBuilder.
+            input_texts (list): The questions, in the order they were numbered.
+
+        Returns:
+            list: For each question, a list of the SQL queries extracted for
+            it. Empty where the batch gave no usable answer.
+        """
+        try:
+            response = self.llm_client.create_chat_completion(
+                model="gpt-4",
+                messages=messages,
+                temperature=0.1,
+                max_tokens=ANSWER_TOKENS * len(input_texts),
+            )
+            respStr = response.choices[0].message.content
+        except Exception as e:
+            logging.exception(f"Error getting SQL queries from batch response: {e}")
+            return [[] for _ in input_texts]
+
+        answers = self.parse_batch_response(respStr, len(input_texts))
+        return [self.extract_sql_query(answer or "") for answer in answers]
+
+    def plan_batches(self, prompt, system_prompt, input_texts, pending, batch_size):
+        """
+        Group the pending questions into batches of at most batch_size that
+        fit the model's context window, estimated from the prompt size plus
+        the completion budget of every question in the batch.
+
+        Args:
+            prompt (GPTPromptBuilder): Builder for the batch prompts.
+            system_prompt (str): The system prompt shared by every batch.
+            input_texts (list): The user's questions.
+            pending (list): Indexes of the questions that need GPT.
+            batch_size (int): Maximum questions per batch.
+
+        Returns:
+            list: The batches, as lists of question indexes.
+        """
+        context_tokens = int(os.getenv("LLM_CONTEXT_TOKENS", 8192))
+        batches = []
+        current = []
+        for index in pending:
+            candidate = current + [index]
+            messages = prompt.construct_batch_prompt(
+                [input_texts[i] for i in candidate], system_prompt
+            )
+            estimated_tokens = RateLimitedOpenAIClient.estimate_tokens(
+                messages, ANSWER_TOKENS * len(candidate)
+            )
+            if current and (len(candidate) > batch_size or estimated_tokens > context_tokens):
+                batches.append(current)
+                current = [index]
+            else:
+                current = candidate
+
+        if current:
+            batches.append(current)
+        return batches
+
+    def run_batch(self, input_texts, upload_file_path, server_side_export=False, batch_size=None):
+        """
+        Run several questions against the user dataset, packing the ones that
+        are not already logged into shared GPT calls so the system prompt is
+        sent once per batch instead of once per question. A question the batch
+        does not answer is retried on its own before it is logged as failed.
+
+        Args:
+            input_texts (list): The user's questions.
+            upload_file_path (str): Optional gs:// path of an uploaded CSV.
+            server_side_export (bool): Export large results server-side.
+            batch_size (int): Maximum questions per GPT call. Defaults to the
+                LLM_BATCH_SIZE environment variable.
+
+        Returns:
+            list: The result link(s) for each question, None where it failed.
+        """
+        batch_size = batch_size or int(os.getenv("LLM_BATCH_SIZE", 5))
+        gs_links = [None] * len(input_texts)
+        pending = []
+
+        check_res = self.bq_manager.fetch_query(None)
+        for index, input_text in enumerate(input_texts):
+            gen_query = self.query_exists_in_cache(check_res, input_text)
+            if gen_query is None:
+                pending.append(index)
+                continue
+
+            logging.info(f"Input already exists in BigQuery : {gen_query}")
+            try:
+                gs_links[index] = self.execute_and_log_query(
+                    gen_query, input_text, server_side_export
+                )
+            except Exception as e:
+                self.bq_manager.run_query(
+                    f"Exception in running the interface: {e}", input_text, 0
+                )
+                logging.exception(f"Exception in running the interface: {e}")
+
+        if not pending:
+            return gs_links
+
+        prompt = GPTPromptBuilder(
+            self.project_id, None, self.user_dataset, self.project_dataset
+        )
+        try:
+            system_prompt = prompt.get_prompt(upload_file_path)
+        except Exception as e:
+            logging.error(f"Error in constructing batch prompt: {e}")
+            return gs_links
+
+        for indexes in self.plan_batches(prompt, system_prompt, input_texts, pending, batch_size):
+            questions = [input_texts[index] for index in indexes]
+            messages = prompt.construct_batch_prompt(questions, system_prompt)
+
+            batch_queries = self.get_sql_queries_from_batch_response(messages, questions)
+            for index, input_text, sql_queries in zip(indexes, questions, batch_queries):
+                if len(sql_queries) == 0:
+                    # Ask again on its own before logging the question as failed
+                    sql_queries = self.get_sql_query_from_response(
+                        prompt.construct_question_prompt(input_text, system_prompt),
+                        input_text,
+                    )
+                if len(sql_queries) == 0:
+                    continue
+
+                query = sql_queries[0]
+                logging.info(f"SQL Query: {query}")
+                try:
+                    gs_links[index] = self.execute_and_log_query(
+                        query, input_text, server_side_export
+                    )
+                except Exception as e:
+                    self.bq_manager.run_query(
+                        f"Exception in running the interface: {e}", input_text, 0
+                    )
+                    logging.exception(f"Exception in running the interface: {e}")
+
+        return gs_links
+
     
     def query_exists_in_cache(self, cached_data, input_text):
         print("INPUT TEXT : ", input_text)
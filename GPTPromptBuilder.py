@@ -1,6 +1,7 @@
 import logging
 from google.cloud import bigquery, storage 
 from google.cloud.bigquery import LoadJobConfig
+from google.api_core.exceptions import NotFound
 from dotenv import load_dotenv
 import os
 from pathlib import Path
@@ -8,6 +9,16 @@ import pandas as pd
 import datetime
 import re
 
+from UploadRegistry import get_upload_registry, identity_labels, upload_identity
+
+# Appended to the system prompt so a batch of questions gets one answer per question.
+BATCH_RESPONSE_FORMAT = (
+    "You will receive several numbered instructions. Respond only with a JSON object "
+    'of the form {"answers": [{"id": <instruction number>, "sql": "<SQL query>"}]} '
+    "containing one answer per instruction. Use an empty string for sql when an "
+    "instruction cannot be answered."
+)
+
  
 class GPTPromptBuilder:
     def __init__(self, project_id, input_str, user_dataset_id, project_dataset_id):
@@ -28,16 +39,37 @@ class GPTPromptBuilder:
             return None
 
         # Format the final prompt with the template and the user's input.
+        prompt = self.construct_question_prompt(self.input_str, my_prompt_string)
+
+        # print("MY PROMPT",prompt)
+        return prompt
+
+    def construct_question_prompt(self, question, system_prompt):
+        # Constructs the prompt for a single question from an already fetched system prompt.
         prompt = [
-            {"role": "system", "content": f"{my_prompt_string}"},
+            {"role": "system", "content": f"{system_prompt}"},
             {
                 "role": "user",
-                "content": f"Translate the following English instruction to SQL Query: {self.input_str}",
+                "content": f"Translate the following English instruction to SQL Query: {question}",
             },
         ]
 
+        return prompt
+
+    def construct_batch_prompt(self, questions, system_prompt):
+        # Constructs a single prompt asking GPT to answer several questions at once.
+        numbered_questions = "\n".join(
+            f"{number}. {question}" for number, question in enumerate(questions, start=1)
+        )
+
+        prompt = [
+            {"role": "system", "content": f"{system_prompt}\n{BATCH_RESPONSE_FORMAT}"},
+            {
+                "role": "user",
+                "content": f"Translate each of the following numbered English instructions to SQL Query:\n{numbered_questions}",
+            },
+        ]
 
-        # print("MY PROMPT",prompt)
         return prompt
     
     
@@ -57,24 +89,87 @@ class GPTPromptBuilder:
 
             destination_file_path = ROOT_DIR /f'{filename}'
 
-            
-            
+            user_out_dataset = os.getenv('USER_OUT_DATASET')
+
+            # Skip the whole ingestion if these exact bytes were already loaded
+            blob = storage.Client().bucket(inp_bucket).get_blob(source_blob_name)
+            identity = upload_identity(inp_bucket, blob)
+
+            # Each generation of the file gets its own table, so a re-upload
+            # never mixes its rows with an earlier version of the file, and any
+            # process finds the same table for the same generation on any day
+            new_table_name = f"{filename.split('.')[0]}_{blob.generation}"
+            registry = get_upload_registry()
+            record = registry.lookup(identity)
+            if record is not None and not self.table_exists(
+                self.project_name, user_out_dataset, record.table_id
+            ):
+                # The table was deleted or expired since it was registered
+                registry.forget(identity)
+                record = None
+            if record is None:
+                record = self.find_ingested_table(
+                    identity, self.project_name, user_out_dataset, new_table_name
+                )
+            if record is not None:
+                print("UPLOAD ALREADY INGESTED : ", record.table_id)
+                return record.table_id, record.schema
+
             print("File Downloaded Start...")
-            csv_file_path = self.download_csv_from_gcs(inp_bucket, source_blob_name, destination_file_path)
+            csv_file_path = self.download_csv_from_gcs(
+                inp_bucket, source_blob_name, destination_file_path, blob.generation
+            )
             print("File Downloaded Finished...", csv_file_path)
 
-            
-            
-            user_out_dataset = os.getenv('USER_OUT_DATASET')
-
-            new_table_name = f"{filename.split('.')[0]}_{datetime.date.today()}"
+            # Only a load known to have succeeded may be reused by later runs
+            if not self.csv_to_bigquery(csv_file_path, self.project_name, user_out_dataset, new_table_name):
+                logging.error(f"Upload {abs_upload_file_path} was not loaded into {new_table_name}")
+                return None
 
-            self.csv_to_bigquery(csv_file_path, self.project_name, user_out_dataset, new_table_name)
             val = self.get_table_schema( self.project_name, user_out_dataset, new_table_name)
             print("VALUE OF SCHEMA COL VAL: ",val, type(val))
+
+            self.label_ingested_table(identity, self.project_name, user_out_dataset, new_table_name)
+            registry.register(identity, new_table_name, val)
+            return new_table_name, val
         else :
             print("ENTER A VALID PATH *")
 
+    def table_exists(self, project_id, dataset_id, table_id):
+        # Checks that a registered upload table is still there before reusing it.
+        client = bigquery.Client(project=project_id)
+        try:
+            client.get_table(client.dataset(dataset_id).table(table_id))
+        except NotFound:
+            return False
+        return True
+
+    def find_ingested_table(self, identity, project_id, dataset_id, table_id):
+        # Reuses a table another process already loaded from the same upload.
+        client = bigquery.Client(project=project_id)
+        try:
+            table = client.get_table(client.dataset(dataset_id).table(table_id))
+        except NotFound:
+            return None
+
+        labels = identity_labels(identity)
+        if any(table.labels.get(key) != value for key, value in labels.items()):
+            return None
+
+        schema = [(field.name, field.field_type) for field in table.schema]
+        return get_upload_registry().register(identity, table_id, schema)
+
+    def label_ingested_table(self, identity, project_id, dataset_id, table_id):
+        # Records the loaded upload on the table so other processes can reuse it.
+        # Best effort: without the labels the upload is only reloaded elsewhere.
+        try:
+            client = bigquery.Client(project=project_id)
+            table = client.get_table(client.dataset(dataset_id).table(table_id))
+            table.labels = {**table.labels, **identity_labels(identity)}
+            client.update_table(table, ["labels"])
+        except Exception as e:
+            logging.error(f"Error labelling ingested table {table_id}: {e}")
+
 
     def get_prompt(self, abs_upload_file_path):
         # Retrieves a prompt template from BigQuery.
@@ -133,11 +228,11 @@ class GPTPromptBuilder:
             logging.error(f"Error in replace_dataset_name method: {e}")
             raise
 
-    def download_csv_from_gcs(self, bucket_name, source_blob_name, destination_file_path):
-        """Download a CSV file from a Google Cloud Storage bucket."""
+    def download_csv_from_gcs(self, bucket_name, source_blob_name, destination_file_path, generation=None):
+        """Download a CSV file, optionally pinned to a generation, from a Google Cloud Storage bucket."""
         storage_client = storage.Client()
         bucket = storage_client.get_bucket(bucket_name)
-        blob = bucket.blob(source_blob_name)
+        blob = bucket.blob(source_blob_name, generation=generation)
 
         # Download the file
         blob.download_to_filename(destination_file_path)
@@ -174,11 +269,12 @@ class GPTPromptBuilder:
             # Construct a reference to the table
             table_ref = dataset_ref.table(table_name)
 
-            # Configure the job to append data if the table exists, create it if not
+            # Configure the job to replace the table if it exists, create it if not
             job_config = bigquery.LoadJobConfig(
                 source_format=bigquery.SourceFormat.CSV,
                 skip_leading_rows=1,  # Skip the header row
                 autodetect=True,      # Automatically detect schema
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
             )
 
             # Load data from a CSV file into the table
@@ -193,9 +289,11 @@ class GPTPromptBuilder:
 
             os.remove(csv_file_path)
             print(f"CSV file {csv_file_path} deleted after uploading to BigQuery")
+            return True
 
         except Exception as e:
             print("Not able to convert ....,",e)
+            return False
          
 
     def get_table_schema(self, project_id, dataset_id, table_id):
@@ -60,3 +60,17 @@ class GoogleCloudStorageManager:
         except Exception as e:
             logging.error(f"Error generating signed URL: {e}")
             return f"An error occurred: {str(e)}"
+
+    def list_gs_urls(self, prefix):
+        """
+        List the gs:// URLs of every object in the bucket under the given prefix.
+        """
+        try:
+            blobs = self.client.list_blobs(self.bucket_name, prefix=prefix)
+            gs_urls = [f"gs://{self.bucket_name}/{blob.name}" for blob in blobs]
+            logging.info(f"Found {len(gs_urls)} objects under gs://{self.bucket_name}/{prefix}")
+            return gs_urls
+
+        except Exception as e:
+            logging.error(f"Error listing objects in Google Cloud Storage: {e}")
+            return []
@@ -0,0 +1,335 @@
+import os
+import time
+import random
+import logging
+import threading
+
+import openai
+from dotenv import load_dotenv
+
+
+# Errors that mean "slow down" and feed back into the concurrency limit
+RATE_LIMIT_ERRORS = (openai.RateLimitError,)
+
+# Rate-limit error code for an exhausted billing quota, which no retry can fix
+INSUFFICIENT_QUOTA = "insufficient_quota"
+
+# Errors that are worth retrying without treating them as a quota signal
+TRANSIENT_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket refilled continuously at a fixed rate. The
+    level may go negative when a request turns out to cost more than was
+    reserved for it, which delays the following requests accordingly.
+
+    Attributes:
+        capacity (float): Maximum number of tokens held by the bucket.
+        rate (float): Tokens added per second.
+    """
+
+    def __init__(self, capacity, rate):
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+        self.level = float(capacity)
+        self.updated_at = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, amount, deadline=None):
+        """
+        Blocks until the requested amount is available and takes it.
+
+        Args:
+            amount (float): Number of tokens to take. Clamped to the capacity.
+            deadline (float): time.monotonic() value after which to give up.
+
+        Returns:
+            bool: True if the tokens were taken, False if the deadline passed.
+        """
+        amount = min(float(amount), self.capacity)
+        with self._cond:
+            while True:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return True
+
+                wait = (amount - self.level) / self.rate
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+                self._cond.wait(wait)
+
+    def adjust(self, amount):
+        """
+        Returns tokens to the bucket (positive amount) or takes extra tokens
+        from it (negative amount) once the real cost of a request is known.
+        """
+        with self._cond:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+            self._cond.notify_all()
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of in-flight requests with an AIMD policy: the limit
+    grows by roughly one slot per window of successful requests and is cut
+    multiplicatively whenever the API answers with a rate-limit error.
+
+    Attributes:
+        limit (float): Current number of allowed in-flight requests.
+        in_flight (int): Number of requests currently holding a slot.
+    """
+
+    def __init__(self, initial_limit, min_limit=1, max_limit=64, decrease_factor=0.5):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, deadline=None):
+        """
+        Blocks until a request slot is free and takes it.
+
+        Args:
+            deadline (float): time.monotonic() value after which to give up.
+
+        Returns:
+            bool: True if a slot was taken, False if the deadline passed.
+        """
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+
+            self.in_flight += 1
+            return True
+
+    def release(self, rate_limited=False, succeeded=True):
+        """
+        Frees a request slot and updates the limit from its outcome.
+
+        Args:
+            rate_limited (bool): Whether the request hit a rate limit.
+            succeeded (bool): Whether the request got a response. Only
+                successes grow the limit.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if rate_limited:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                logging.warning(f"Rate limited, concurrency limit lowered to {self.limit:.2f}")
+            elif succeeded:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+class RateLimitedOpenAIClient:
+    """
+    RateLimitedOpenAIClient wraps chat completion calls so that a process
+    paces itself at its OpenAI quota instead of failing calls against it.
+    Requests and tokens are metered by token buckets, concurrency adapts to
+    rate-limit responses, and retryable errors are retried with jittered
+    exponential backoff until the per-request deadline.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute,
+        tokens_per_minute,
+        max_concurrency=8,
+        max_retries=6,
+        base_backoff=1.0,
+        max_backoff=60.0,
+        request_deadline=120.0,
+        transport=None,
+    ):
+        """
+        Initializes the RateLimitedOpenAIClient.
+
+        Args:
+            requests_per_minute (int): Request quota of the API key.
+            tokens_per_minute (int): Token quota of the API key.
+            max_concurrency (int): Upper bound for the adaptive concurrency limit.
+            max_retries (int): Retries after the first attempt.
+            base_backoff (float): Backoff in seconds before the first retry.
+            max_backoff (float): Upper bound for a single backoff in seconds.
+            request_deadline (float): Default time budget of a request in
+                seconds, including queueing and retries.
+            transport (OpenAI): Client the requests are sent with. Defaults to
+                one with the SDK's own retries disabled, so every attempt goes
+                through the limits and backoff here.
+        """
+        self.request_bucket = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self.token_bucket = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+        self.limiter = AdaptiveConcurrencyLimiter(
+            initial_limit=max(1, max_concurrency // 2), max_limit=max_concurrency
+        )
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.request_deadline = request_deadline
+        self.transport = transport
+        self._transport_lock = threading.Lock()
+
+    def get_transport(self):
+        """
+        Returns the OpenAI client requests are sent with, creating it on first
+        use once the API key has been loaded.
+        """
+        with self._transport_lock:
+            if self.transport is None:
+                self.transport = openai.OpenAI(api_key=openai.api_key, max_retries=0)
+            return self.transport
+
+    @staticmethod
+    def estimate_tokens(messages, max_tokens):
+        """
+        Estimates the token cost of a request at roughly four characters per
+        prompt token, plus the completion budget.
+        """
+        prompt_chars = sum(len(message.get("content") or "") for message in messages)
+        return prompt_chars // 4 + max_tokens
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+
+        # Honour the server's hint when it asks us to wait longer
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+
+        return delay
+
+    def create_chat_completion(self, messages, model, temperature, max_tokens, deadline=None):
+        """
+        Creates a chat completion within the request and token quotas.
+
+        Args:
+            messages (list): The conversation messages.
+            model (str): The model name.
+            temperature (float): The sampling temperature.
+            max_tokens (int): The completion token budget.
+            deadline (float): Time budget of this request in seconds. Defaults
+                to the client's request deadline.
+
+        Returns:
+            ChatCompletion: The OpenAI response.
+
+        Raises:
+            TimeoutError: If the deadline passed before a response was received.
+            openai.OpenAIError: If the request failed with a non-retryable error
+                or the retries were exhausted.
+        """
+        deadline_at = time.monotonic() + (deadline or self.request_deadline)
+        # The bucket never hands out more than its capacity, so neither is
+        # more reserved, returned or settled against
+        estimated_tokens = min(
+            self.estimate_tokens(messages, max_tokens), self.token_bucket.capacity
+        )
+
+        transport = self.get_transport()
+        attempt = 0
+        while True:
+            if not self.request_bucket.acquire(1, deadline_at):
+                raise TimeoutError("Deadline exceeded waiting for the request quota")
+            if not self.token_bucket.acquire(estimated_tokens, deadline_at):
+                self.request_bucket.adjust(1)
+                raise TimeoutError("Deadline exceeded waiting for the token quota")
+            if not self.limiter.acquire(deadline_at):
+                self.request_bucket.adjust(1)
+                self.token_bucket.adjust(estimated_tokens)
+                raise TimeoutError("Deadline exceeded waiting for a concurrency slot")
+
+            rate_limited = False
+            succeeded = False
+            try:
+                response = transport.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    timeout=max(0.0, deadline_at - time.monotonic()),
+                )
+            except Exception as e:
+                # A failed attempt does not use up its token reservation
+                self.token_bucket.adjust(estimated_tokens)
+                if not isinstance(e, RATE_LIMIT_ERRORS + TRANSIENT_ERRORS):
+                    raise
+                if getattr(e, "code", None) == INSUFFICIENT_QUOTA:
+                    logging.error(f"OpenAI quota exhausted, not retrying: {e}")
+                    raise
+
+                rate_limited = isinstance(e, RATE_LIMIT_ERRORS)
+                delay = self._backoff(attempt, e)
+                if attempt >= self.max_retries or time.monotonic() + delay >= deadline_at:
+                    logging.error(f"OpenAI request failed after {attempt + 1} attempts: {e}")
+                    raise
+
+                logging.warning(
+                    f"OpenAI request attempt {attempt + 1} failed, retrying in {delay:.2f}s: {e}"
+                )
+            else:
+                succeeded = True
+                # Settle the token reservation against the real usage
+                usage = getattr(response, "usage", None)
+                if usage is not None:
+                    self.token_bucket.adjust(estimated_tokens - usage.total_tokens)
+                return response
+            finally:
+                self.limiter.release(rate_limited=rate_limited, succeeded=succeeded)
+
+            attempt += 1
+            time.sleep(delay)
+
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def get_shared_client():
+    """
+    Returns the process-wide RateLimitedOpenAIClient, creating it on first use
+    from the OPENAI_MAX_RPM, OPENAI_MAX_TPM, OPENAI_MAX_CONCURRENCY,
+    OPENAI_MAX_RETRIES and OPENAI_REQUEST_DEADLINE environment variables. The
+    quotas belong to the API key, so every interface in the process shares it.
+
+    Returns:
+        RateLimitedOpenAIClient: The shared client.
+    """
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            load_dotenv()
+            _shared_client = RateLimitedOpenAIClient(
+                requests_per_minute=int(os.getenv("OPENAI_MAX_RPM", 500)),
+                tokens_per_minute=int(os.getenv("OPENAI_MAX_TPM", 40000)),
+                max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", 8)),
+                max_retries=int(os.getenv("OPENAI_MAX_RETRIES", 6)),
+                request_deadline=float(os.getenv("OPENAI_REQUEST_DEADLINE", 120)),
+            )
+        return _shared_client
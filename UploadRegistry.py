@@ -0,0 +1,103 @@
+import base64
+import logging
+import threading
+
+
+class UploadRecord:
+    """
+    The BigQuery table an uploaded file was loaded into, with its schema.
+    """
+
+    __slots__ = ("table_id", "schema")
+
+    def __init__(self, table_id, schema):
+        self.table_id = table_id
+        self.schema = schema
+
+
+def upload_identity(bucket_name, blob):
+    """
+    Builds the identity of an uploaded object from its GCS metadata. The
+    generation changes on every overwrite and the CRC32C pins the content, so
+    an identity only matches when the exact same bytes were already ingested.
+
+    Args:
+        bucket_name (str): The bucket holding the object.
+        blob (Blob): The object, with its metadata loaded.
+
+    Returns:
+        tuple: The (bucket, object name, generation, crc32c) identity.
+    """
+    checksum = blob.crc32c or blob.md5_hash or ""
+    return (
+        bucket_name,
+        blob.name,
+        str(blob.generation),
+        base64.b64decode(checksum).hex(),
+    )
+
+
+def identity_labels(identity):
+    """
+    Returns the BigQuery table labels recording an upload identity, so that a
+    table loaded by another process can be recognised without reloading it.
+    """
+    _, _, generation, checksum = identity
+    return {"source_generation": generation, "source_checksum": checksum}
+
+
+class UploadRegistry:
+    """
+    UploadRegistry maps already-ingested uploads to the table and schema they
+    were loaded into, so re-running an analysis against the same file skips
+    the download, the load job and the schema fetch.
+    """
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, identity):
+        """
+        Returns the record for an upload identity, or None if it was never
+        registered.
+        """
+        with self._lock:
+            record = self._records.get(identity)
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return record
+
+    def register(self, identity, table_id, schema):
+        """
+        Records the table and schema an upload was loaded into.
+        """
+        with self._lock:
+            record = self._records[identity] = UploadRecord(table_id, schema)
+            logging.info(f"Registered upload gs://{identity[0]}/{identity[1]} as {table_id}")
+            return record
+
+    def forget(self, identity):
+        """
+        Drops the record of an upload whose table no longer exists.
+        """
+        with self._lock:
+            self._records.pop(identity, None)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._records), "hits": self.hits, "misses": self.misses}
+
+
+_upload_registry = UploadRegistry()
+
+
+def get_upload_registry():
+    """
+    Returns the process-wide UploadRegistry.
+    """
+    return _upload_registry
@@ -0,0 +1,529 @@
+import os
+import sys
+import csv
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import threading
+import httpx
+import openai
+from types import SimpleNamespace
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from BigQueryConnect import BigQueryManager
+from CacheManager import SharedCacheManager
+from OpenAIClient import RateLimitedOpenAIClient, TokenBucket
+from GPTBigQueryInterface import GPTBigQueryInterface
+
+# Mean service latencies in seconds used when none are given
+DEFAULT_LATENCY_MEANS = {
+    "bq_lookup": 1.5,
+    "bq_query": 3.0,
+    "bq_export": 5.0,
+    "bq_insert": 1.0,
+    "llm": 6.0,
+}
+
+# RateLimitedOpenAIClient settings used when none are given, matching the
+# defaults of the shared production client
+DEFAULT_LLM_SETTINGS = {
+    "requests_per_minute": 500,
+    "tokens_per_minute": 40000,
+    "max_concurrency": 8,
+    "max_retries": 6,
+    "request_deadline": 120.0,
+}
+
+
+def load_history(history_path):
+    """
+    Loads exported 'de_genai_logs' rows from a CSV or JSON lines file, sorted
+    by their creation time.
+
+    Args:
+        history_path (str): Path to a .csv or .jsonl export with input_text,
+            generated_query, created_at and user_dataset columns.
+
+    Returns:
+        list: The rows as dictionaries, with created_at parsed to a datetime.
+    """
+    with open(history_path, newline="") as history_file:
+        if history_path.endswith(".csv"):
+            rows = list(csv.DictReader(history_file))
+        else:
+            rows = [json.loads(line) for line in history_file if line.strip()]
+
+    for row in rows:
+        row["created_at"] = datetime.fromisoformat(str(row["created_at"]))
+    rows.sort(key=lambda row: row["created_at"])
+    return rows
+
+
+def percentile(values, pct):
+    """
+    Returns the nearest-rank percentile of a list of values, or None if empty.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class SimulatedClock:
+    """
+    A clock running time_compression times faster than wall-clock time, so
+    hours of recorded traffic can be replayed in minutes. All reported times
+    and the cache time-to-live are measured in simulated seconds.
+    """
+
+    def __init__(self, time_compression):
+        self.time_compression = time_compression
+        self.started_at = time.monotonic()
+
+    def now(self):
+        return (time.monotonic() - self.started_at) * self.time_compression
+
+    def sleep_until(self, simulated_time):
+        delay = (simulated_time - self.now()) / self.time_compression
+        if delay > 0:
+            time.sleep(delay)
+
+    def sleep(self, simulated_seconds):
+        time.sleep(simulated_seconds / self.time_compression)
+
+
+class SimulatedLatency:
+    """
+    Samples service latencies from log-normal distributions with the given
+    means (in simulated seconds) and sleeps for them on the simulated clock.
+    """
+
+    def __init__(self, clock, means, sigma=0.5, seed=None):
+        self.clock = clock
+        self.means = means
+        self.sigma = sigma
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self, service):
+        mu = math.log(self.means[service]) - self.sigma ** 2 / 2
+        with self._lock:
+            latency = self.random.lognormvariate(mu, self.sigma)
+        self.clock.sleep(latency)
+
+
+class SimulatedLogStore:
+    """
+    The in-memory 'de_genai_logs' table the simulated managers read and write.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def append(self, input_text, generated_query, status, user_dataset):
+        created_at = self.clock.now()
+        with self._lock:
+            self.rows.append(
+                {
+                    "input_text": input_text,
+                    "generated_query": generated_query,
+                    "status": status,
+                    "user_dataset": user_dataset,
+                }
+            )
+        return created_at
+
+    def successful(self, user_dataset):
+        with self._lock:
+            return [
+                {"input_text": row["input_text"], "generated_query": row["generated_query"]}
+                for row in self.rows
+                if row["status"] == 1 and row["user_dataset"] == user_dataset
+            ]
+
+
+class SimulatedBigQueryManager(BigQueryManager):
+    """
+    A BigQueryManager answering from an in-memory 'de_genai_logs' table with
+    simulated latencies instead of calling BigQuery. It keeps the real cache
+    path of fetch_query, so cache settings behave as they would in production.
+    """
+
+    def __init__(self, project_id, dataset_id, user_dataset, cache, log_store, latency):
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.user_dataset = user_dataset
+        self.cache = cache
+        self.cache_namespace = (project_id, dataset_id, user_dataset)
+        self.log_store = log_store
+        self.latency = latency
+
+    def buffer_check(self, input_text):
+        self.latency.wait("bq_lookup")
+        return self.log_store.successful(self.user_dataset)
+
+    def run_query(self, _query, input_text, status_id):
+        # An insert followed by the SELECT of the latest created_at
+        self.latency.wait("bq_insert")
+        created_at = self.log_store.append(input_text, _query, status_id, self.user_dataset)
+        if status_id == 1:
+            self.remember_logged_query(input_text, _query)
+        return [created_at]
+
+    def run_generated_query(self, gen_query):
+        self.latency.wait("bq_query")
+        return f"gs://simulated/{self.user_dataset}/{abs(hash(gen_query))}.csv"
+
+    def export_generated_query(self, gen_query, preview_rows=10):
+        self.latency.wait("bq_export")
+        return {
+            "uris": [f"gs://simulated/{self.user_dataset}/{abs(hash(gen_query))}/part-0.csv"],
+            "preview": [],
+            "total_rows": 0,
+        }
+
+
+class ReplayInterface(GPTBigQueryInterface):
+    """
+    A GPTBigQueryInterface that flags on the replayed request's thread whether
+    the question was answered from the query log.
+    """
+
+    def __init__(self, project_id, user_dataset, bq_manager, llm_client, current):
+        super().__init__(project_id, user_dataset, bq_manager=bq_manager, llm_client=llm_client)
+        self.current = current
+
+    def query_exists_in_cache(self, cached_data, input_text):
+        gen_query = super().query_exists_in_cache(cached_data, input_text)
+        if gen_query is not None:
+            self.current.log_hit = True
+        return gen_query
+
+
+class SimulatedOpenAITransport:
+    """
+    Stands in for the OpenAI client under RateLimitedOpenAIClient. It answers
+    with the query recorded in the history for the question being replayed on
+    the calling thread, and rejects requests over the provider quota with a
+    429 the way the API does, so the client's pacing and AIMD react to it.
+    """
+
+    def __init__(self, clock, latency, requests_per_minute, tokens_per_minute):
+        self.clock = clock
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=self)
+        self.request_quota = scaled_bucket(requests_per_minute, clock)
+        self.token_quota = scaled_bucket(tokens_per_minute, clock)
+        self.current = threading.local()
+        self.calls = 0
+        self.rate_limited = 0
+        self.requests = set()
+        self._lock = threading.Lock()
+
+    def create(self, model, messages, temperature, max_tokens, timeout=None):
+        with self._lock:
+            self.calls += 1
+            self.requests.add(self.current.request_id)
+
+        answer = self.current.generated_query or ""
+        prompt_tokens = RateLimitedOpenAIClient.estimate_tokens(messages, 0)
+        total_tokens = prompt_tokens + len(answer) // 4
+        now = time.monotonic()
+        if not self.request_quota.acquire(1, now) or not self.token_quota.acquire(total_tokens, now):
+            with self._lock:
+                self.rate_limited += 1
+            request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+            raise openai.RateLimitError(
+                "Simulated rate limit reached",
+                response=httpx.Response(429, request=request),
+                body=None,
+            )
+
+        self.latency.wait("llm")
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=answer))],
+            usage=SimpleNamespace(total_tokens=total_tokens),
+        )
+
+
+def scaled_bucket(per_minute, clock):
+    """
+    Returns a TokenBucket holding one simulated minute of quota and refilling
+    at the simulated rate, measured in wall-clock seconds.
+    """
+    return TokenBucket(per_minute, per_minute * clock.time_compression / 60.0)
+
+
+class WorkloadReplay:
+    """
+    WorkloadReplay replays recorded questions against GPTBigQueryInterface at
+    their original arrival pattern, compressed in time, with simulated service
+    latencies. GPT calls go through a real RateLimitedOpenAIClient in front of
+    a simulated API with its own quota. It reports cache hit rates per layer,
+    LLM pacing, throughput, queueing delay and latency percentiles so cache,
+    quota and concurrency settings can be tuned offline.
+    """
+
+    def __init__(
+        self,
+        history,
+        time_compression=60.0,
+        concurrency=4,
+        cache_max_bytes=256 * 1024 * 1024,
+        cache_tenant_quota_bytes=None,
+        cache_ttl=None,
+        latency_means=None,
+        llm_settings=None,
+        provider_quota=None,
+        prompt_tokens=2000,
+        server_side_export=False,
+        seed=None,
+    ):
+        """
+        Initializes the WorkloadReplay.
+
+        Args:
+            history (list): Rows returned by load_history.
+            time_compression (float): How many simulated seconds pass per
+                wall-clock second.
+            concurrency (int): Number of requests served in parallel.
+            cache_max_bytes (int): Global byte budget of the shared cache.
+            cache_tenant_quota_bytes (int): Per-dataset byte budget.
+            cache_ttl (float): Cache time-to-live in simulated seconds.
+            latency_means (dict): Mean latency per service in simulated seconds,
+                overriding DEFAULT_LATENCY_MEANS.
+            llm_settings (dict): RateLimitedOpenAIClient settings in real
+                units (per minute, seconds), overriding DEFAULT_LLM_SETTINGS.
+            provider_quota (dict): requests_per_minute and tokens_per_minute
+                enforced by the simulated API. Defaults to the client's quotas.
+            prompt_tokens (int): Size of the simulated GPT prompt in tokens.
+            server_side_export (bool): Replay with server-side result export.
+            seed (int): Seed for the latency sampling.
+        """
+        self.history = history
+        self.concurrency = concurrency
+        self.clock = SimulatedClock(time_compression)
+        self.latency = SimulatedLatency(
+            self.clock, {**DEFAULT_LATENCY_MEANS, **(latency_means or {})}, seed=seed
+        )
+        self.cache = SharedCacheManager(
+            cache_max_bytes, cache_tenant_quota_bytes, ttl=cache_ttl, timer=self.clock.now
+        )
+        self.log_store = SimulatedLogStore(self.clock)
+        self.server_side_export = server_side_export
+        self.prompt_tokens = prompt_tokens
+
+        llm_settings = {**DEFAULT_LLM_SETTINGS, **(llm_settings or {})}
+        provider_quota = {
+            "requests_per_minute": llm_settings["requests_per_minute"],
+            "tokens_per_minute": llm_settings["tokens_per_minute"],
+            **(provider_quota or {}),
+        }
+        self.transport = SimulatedOpenAITransport(
+            self.clock,
+            self.latency,
+            provider_quota["requests_per_minute"],
+            provider_quota["tokens_per_minute"],
+        )
+        # The real client paces in wall-clock time, so its durations are
+        # compressed and its quotas refill at the simulated rate
+        self.llm_client = RateLimitedOpenAIClient(
+            requests_per_minute=llm_settings["requests_per_minute"],
+            tokens_per_minute=llm_settings["tokens_per_minute"],
+            max_concurrency=llm_settings["max_concurrency"],
+            max_retries=llm_settings["max_retries"],
+            base_backoff=1.0 / time_compression,
+            max_backoff=60.0 / time_compression,
+            request_deadline=llm_settings["request_deadline"] / time_compression,
+            transport=self.transport,
+        )
+        self.llm_client.request_bucket = scaled_bucket(llm_settings["requests_per_minute"], self.clock)
+        self.llm_client.token_bucket = scaled_bucket(llm_settings["tokens_per_minute"], self.clock)
+        self.interfaces = {}
+        self.current = threading.local()
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def get_interface(self, user_dataset):
+        with self._lock:
+            interface = self.interfaces.get(user_dataset)
+            if interface is None:
+                bq_manager = SimulatedBigQueryManager(
+                    "simulated", "simulated", user_dataset, self.cache, self.log_store, self.latency
+                )
+                interface = ReplayInterface(
+                    "simulated", user_dataset, bq_manager, self.llm_client, self.current
+                )
+                # Prompt construction reads de_prompt_store and is not replayed
+                interface.prompt = [{"role": "system", "content": "x" * 4 * self.prompt_tokens}]
+                self.interfaces[user_dataset] = interface
+            return interface
+
+    def serve(self, request_id, row, arrived_at):
+        started_at = self.clock.now()
+        self.transport.current.request_id = request_id
+        self.transport.current.generated_query = row.get("generated_query")
+        self.current.log_hit = False
+        result = self.get_interface(row["user_dataset"]).run(
+            row["input_text"], None, self.server_side_export
+        )
+        finished_at = self.clock.now()
+
+        with self._lock:
+            self.samples.append(
+                {
+                    "queue_delay": started_at - arrived_at,
+                    "latency": finished_at - arrived_at,
+                    "succeeded": bool(result),
+                    "log_hit": self.current.log_hit,
+                }
+            )
+
+    def run(self):
+        """
+        Replays the history and returns the report.
+
+        Returns:
+            dict: Cache, throughput, queueing and latency statistics.
+        """
+        if not self.history:
+            return {}
+
+        first_created_at = self.history[0]["created_at"]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for request_id, row in enumerate(self.history):
+                arrival = (row["created_at"] - first_created_at).total_seconds()
+                self.clock.sleep_until(arrival)
+                executor.submit(self.serve, request_id, row, self.clock.now())
+        elapsed = self.clock.now()
+
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        requests = len(self.samples)
+        cache_stats = self.cache.stats()
+        cache_lookups = cache_stats["hits"] + cache_stats["misses"]
+        log_hits = sum(sample["log_hit"] for sample in self.samples)
+        queue_delays = [sample["queue_delay"] for sample in self.samples]
+        latencies = [sample["latency"] for sample in self.samples]
+
+        return {
+            "requests": requests,
+            "succeeded": sum(sample["succeeded"] for sample in self.samples),
+            "simulated_seconds": elapsed,
+            "throughput_per_second": requests / elapsed if elapsed > 0 else None,
+            "cache_layers": {
+                "shared_cache": {
+                    "hit_rate": cache_stats["hits"] / cache_lookups if cache_lookups else None,
+                    "hits": cache_stats["hits"],
+                    "misses": cache_stats["misses"],
+                    "evictions": cache_stats["evictions"],
+                    "expirations": cache_stats["expirations"],
+                    "bytes": cache_stats["size"],
+                },
+                "query_log": {
+                    "hit_rate": log_hits / requests if requests else None,
+                    "hits": log_hits,
+                },
+            },
+            "llm": {
+                "requests": len(self.transport.requests),
+                "attempts": self.transport.calls,
+                "rate_limited": self.transport.rate_limited,
+                "concurrency_limit": self.llm_client.limiter.limit,
+            },
+            "queue_delay": {
+                f"p{pct}": percentile(queue_delays, pct) for pct in (50, 90, 95, 99)
+            },
+            "latency": {
+                f"p{pct}": percentile(latencies, pct) for pct in (50, 90, 95, 99)
+            },
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay exported de_genai_logs history with simulated latencies."
+    )
+    parser.add_argument("history_path", help="CSV or JSON lines export of de_genai_logs")
+    parser.add_argument("--time-compression", type=float, default=60.0)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--cache-max-bytes", type=int, default=256 * 1024 * 1024)
+    parser.add_argument("--cache-tenant-quota-bytes", type=int, default=None)
+    parser.add_argument("--cache-ttl", type=float, default=None, help="simulated seconds")
+    parser.add_argument("--bq-lookup-latency", type=float, default=DEFAULT_LATENCY_MEANS["bq_lookup"])
+    parser.add_argument("--bq-query-latency", type=float, default=DEFAULT_LATENCY_MEANS["bq_query"])
+    parser.add_argument("--bq-export-latency", type=float, default=DEFAULT_LATENCY_MEANS["bq_export"])
+    parser.add_argument("--bq-insert-latency", type=float, default=DEFAULT_LATENCY_MEANS["bq_insert"])
+    parser.add_argument("--llm-latency", type=float, default=DEFAULT_LATENCY_MEANS["llm"])
+    parser.add_argument("--llm-max-rpm", type=int, default=DEFAULT_LLM_SETTINGS["requests_per_minute"])
+    parser.add_argument("--llm-max-tpm", type=int, default=DEFAULT_LLM_SETTINGS["tokens_per_minute"])
+    parser.add_argument("--llm-max-concurrency", type=int, default=DEFAULT_LLM_SETTINGS["max_concurrency"])
+    parser.add_argument("--llm-max-retries", type=int, default=DEFAULT_LLM_SETTINGS["max_retries"])
+    parser.add_argument("--llm-request-deadline", type=float, default=DEFAULT_LLM_SETTINGS["request_deadline"])
+    parser.add_argument("--provider-rpm", type=int, default=None, help="defaults to --llm-max-rpm")
+    parser.add_argument("--provider-tpm", type=int, default=None, help="defaults to --llm-max-tpm")
+    parser.add_argument("--prompt-tokens", type=int, default=2000)
+    parser.add_argument("--server-side-export", action="store_true")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    replay = WorkloadReplay(
+        load_history(args.history_path),
+        time_compression=args.time_compression,
+        concurrency=args.concurrency,
+        cache_max_bytes=args.cache_max_bytes,
+        cache_tenant_quota_bytes=args.cache_tenant_quota_bytes,
+        cache_ttl=args.cache_ttl,
+        latency_means={
+            "bq_lookup": args.bq_lookup_latency,
+            "bq_query": args.bq_query_latency,
+            "bq_export": args.bq_export_latency,
+            "bq_insert": args.bq_insert_latency,
+            "llm": args.llm_latency,
+        },
+        llm_settings={
+            "requests_per_minute": args.llm_max_rpm,
+            "tokens_per_minute": args.llm_max_tpm,
+            "max_concurrency": args.llm_max_concurrency,
+            "max_retries": args.llm_max_retries,
+            "request_deadline": args.llm_request_deadline,
+        },
+        provider_quota={
+            key: value
+            for key, value in (
+                ("requests_per_minute", args.provider_rpm),
+                ("tokens_per_minute", args.provider_tpm),
+            )
+            if value is not None
+        },
+        prompt_tokens=args.prompt_tokens,
+        server_side_export=args.server_side_export,
+        seed=args.seed,
+    )
+
+    # The interface prints progress for every request; keep the report readable
+    stdout = sys.stdout
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        sys.stdout = open(os.devnull, "w")
+    try:
+        report = replay.run()
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()